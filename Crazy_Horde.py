@@ -1,34 +1,122 @@
+import array
 import chess
 import chess.pgn
 import chess.polyglot
 import chess.variant
 import datetime
+import functools
+import itertools
+import mmap
+import multiprocessing
+import numpy as np
 import os
+import struct
 
 MAX_BOOK_PLIES = 20
 MAX_BOOK_WEIGHT = 10000
-
-def format_zobrist_key_hex(zobrist_key):
-    return "%0.16x" % zobrist_key
-
-def get_zobrist_key_hex(board):
-    return format_zobrist_key_hex(chess.polyglot.zobrist_hash(board))
-
-class BookMove:
-    def __init__(self):
-        self.weight = 0
-        self.move = None
+POLYGLOT_ENTRY_DTYPE = np.dtype([('key', '>u8'), ('move', '>u2'), ('weight', '>u2'), ('learn', '>u4')])
+POLYGLOT_ENTRY_STRUCT = struct.Struct('>QHHI')
+# Games with any other result (unfinished, aborted) add nothing to the book
+SCORED_RESULTS = ("1-0", "0-1", "1/2-1/2")
+
+# Polyglot encodes castling as the king capturing its own rook
+CASTLING_ROOK_SQUARES = {
+    (chess.E1, chess.G1): chess.H1,
+    (chess.E1, chess.C1): chess.A1,
+    (chess.E8, chess.G8): chess.H8,
+    (chess.E8, chess.C8): chess.A8,
+}
+
+def get_zobrist_key(board):
+    return chess.polyglot.zobrist_hash(board)
+
+def encode_polyglot_move(move):
+    mi = move.to_square | (move.from_square << 6)
+    if move.promotion:
+        mi |= (move.promotion - 1) << 12
+    elif move.drop:  # Handle Crazyhouse drops
+        mi |= (move.drop - 1) << 12
+    return mi
+
+POLYGLOT_RANDOM_ARRAY = chess.polyglot.POLYGLOT_RANDOM_ARRAY
+POLYGLOT_HASHER = chess.polyglot.ZobristHasher(POLYGLOT_RANDOM_ARRAY)
+# Variants whose moves only touch the squares ZobristBoard.push accounts for;
+# others (e.g. atomic explosions) are rehashed in full after every move
+INCREMENTAL_ZOBRIST_VARIANTS = {
+    "chess", "crazyhouse", "horde", "antichess", "racingkings", "3check", "kingofthehill",
+}
+
+def polyglot_piece_random(piece_type, color, square):
+    return POLYGLOT_RANDOM_ARRAY[64 * ((piece_type - 1) * 2 + color) + square]
+
+class ZobristBoard:
+    # Keeps the polyglot key of a board up to date by XORing in and out only
+    # what a move changes, instead of rehashing the whole position every ply.
+    def __init__(self, board):
+        self.board = board
+        self.key = get_zobrist_key(board)
+        self.castling_rights = board.castling_rights
+        self.castling_key = POLYGLOT_HASHER.hash_castling(board)
+        self.ep_key = POLYGLOT_HASHER.hash_ep_square(board) if board.ep_square else 0
+        self.incremental = board.uci_variant in INCREMENTAL_ZOBRIST_VARIANTS
+
+    def push(self, move):
+        board = self.board
+        if not self.incremental:
+            board.push(move)
+            self.key = get_zobrist_key(board)
+            return
+
+        piece_random = polyglot_piece_random
+        turn = board.turn
+        to_square = move.to_square
+        key = self.key ^ self.ep_key ^ POLYGLOT_RANDOM_ARRAY[780]
+
+        if move.drop:
+            key ^= piece_random(move.drop, turn, to_square)
+        else:
+            from_square = move.from_square
+            piece_type = board.piece_type_at(from_square)
+            key ^= piece_random(piece_type, turn, from_square)
+            if piece_type == chess.KING and board.is_castling(move):
+                back_rank = from_square & ~7
+                if chess.square_file(to_square) > chess.square_file(from_square):
+                    rook_from, king_to, rook_to = back_rank + 7, back_rank + 6, back_rank + 5
+                else:
+                    rook_from, king_to, rook_to = back_rank, back_rank + 2, back_rank + 3
+                if board.color_at(to_square) == turn:  # king takes own rook notation
+                    rook_from = to_square
+                key ^= piece_random(chess.ROOK, turn, rook_from)
+                key ^= piece_random(chess.ROOK, turn, rook_to)
+                key ^= piece_random(chess.KING, turn, king_to)
+            else:
+                if piece_type == chess.PAWN and to_square == board.ep_square and board.is_en_passant(move):
+                    victim_square = to_square - 8 if turn == chess.WHITE else to_square + 8
+                    key ^= piece_random(chess.PAWN, not turn, victim_square)
+                else:
+                    captured = board.piece_type_at(to_square)
+                    if captured:
+                        key ^= piece_random(captured, not turn, to_square)
+                key ^= piece_random(move.promotion or piece_type, turn, to_square)
+
+        board.push(move)
+
+        if board.castling_rights != self.castling_rights:
+            key ^= self.castling_key
+            self.castling_rights = board.castling_rights
+            self.castling_key = POLYGLOT_HASHER.hash_castling(board)
+            key ^= self.castling_key
+        self.ep_key = POLYGLOT_HASHER.hash_ep_square(board) if board.ep_square else 0
+        self.key = key ^ self.ep_key
 
 class BookPosition:
+    __slots__ = ('weights',)
+
     def __init__(self):
-        self.moves = {}
-        self.fen = ""
+        self.weights = {}
 
-    def get_move(self, uci):
-        if uci in self.moves:
-            return self.moves[uci]
-        self.moves[uci] = BookMove()
-        return self.moves[uci]
+    def add_weight(self, mi, weight):
+        self.weights[mi] = self.weights.get(mi, 0) + weight
 
 class Book:
     def __init__(self):
@@ -36,74 +124,104 @@ class Book:
         self.numpositions = 0
         self.nummoves = 0
 
-    def get_position(self, zobrist_key_hex):
-        if zobrist_key_hex in self.positions:
-            return self.positions[zobrist_key_hex]
-        self.positions[zobrist_key_hex] = BookPosition()
-        return self.positions[zobrist_key_hex]
+    def get_position(self, zobrist_key):
+        bp = self.positions.get(zobrist_key)
+        if bp is None:
+            bp = self.positions[zobrist_key] = BookPosition()
+        return bp
+
+    def add_game(self, board, moves, score):
+        # Everything the ply loop touches is bound to a local first
+        get_position = self.get_position
+        piece_type_at = board.piece_type_at
+        castling_rook_squares = CASTLING_ROOK_SQUARES
+        king = chess.KING
+        zboard = ZobristBoard(board)
+        push = zboard.push
+        bp = get_position(zboard.key)
+        # Score for the side to move, indexed by ply parity
+        score_corrs = (score, 2 - score) if board.turn == chess.WHITE else (2 - score, score)
+        for ply, move in enumerate(itertools.islice(moves, MAX_BOOK_PLIES)):
+            mi = encode_polyglot_move(move)
+
+            # Handle castling moves for standard-like behavior
+            from_square = move.from_square
+            rook_square = castling_rook_squares.get((from_square, move.to_square))
+            if rook_square is not None and piece_type_at(from_square) == king:
+                mi = (mi & ~0x3f) | rook_square
+
+            weights = bp.weights
+            weights[mi] = weights.get(mi, 0) + score_corrs[ply & 1]
+
+            push(move)
+            bp = get_position(zboard.key)
 
     def normalize_weights(self):
-        for zobrist_key_hex in self.positions:
-            bp = self.positions[zobrist_key_hex]
+        for zobrist_key in self.positions:
+            weights = self.positions[zobrist_key].weights
             max_weight = 0
             total_weight = 0
-            for uci in bp.moves:
-                bm = bp.moves[uci]
-                if bm.weight > max_weight:
-                    max_weight = bm.weight
-                total_weight += bm.weight
+            for weight in weights.values():
+                if weight > max_weight:
+                    max_weight = weight
+                total_weight += weight
             if max_weight > MAX_BOOK_WEIGHT:
-                for uci in bp.moves:
-                    bm = bp.moves[uci]
-                    bm.weight = int(bm.weight / total_weight * MAX_BOOK_WEIGHT)
+                for mi in weights:
+                    weights[mi] = int(weights[mi] / total_weight * MAX_BOOK_WEIGHT)
 
     def save_as_polyglot(self, path):
         self.numpositions = 0
         self.nummoves = 0
+        keys = array.array('Q')
+        moves = array.array('H')
+        weights = array.array('H')
+        for zobrist_key in self.positions:
+            bp = self.positions[zobrist_key]
+            posnotcounted = True
+            for mi, weight in bp.weights.items():
+                if weight > 0:
+                    keys.append(zobrist_key)
+                    moves.append(mi)
+                    weights.append(weight)
+                    self.nummoves += 1
+                    if posnotcounted:
+                        self.numpositions += 1
+                        posnotcounted = False
+        allentries = np.zeros(self.nummoves, dtype=POLYGLOT_ENTRY_DTYPE)
+        allentries['key'] = keys
+        allentries['move'] = moves
+        allentries['weight'] = weights
+        # Stable sort on the native-endian columns: a radix pass on the 16-bit
+        # weights (heaviest first), then by key keeping that order within a key
+        order = np.argsort(~np.frombuffer(weights, dtype=np.uint16), kind='stable')
+        order = order[np.argsort(np.frombuffer(keys, dtype=np.uint64)[order], kind='stable')]
+        allentries = allentries[order]
+        print("total of {} moves added to book {}".format(len(allentries), path))
         with open(path, 'wb') as outfile:
-            allentries = []
-            for zobrist_key_hex in self.positions:
-                zbytes = bytes.fromhex(zobrist_key_hex)
-                bp = self.positions[zobrist_key_hex]
-                posnotcounted = True
-                for uci in bp.moves:
-                    m = bp.moves[uci].move
-                    mi = m.to_square + (m.from_square << 6)
-                    if m.promotion is not None:
-                        mi += ((m.promotion - 1) << 12)
-                    elif m.drop is not None:  # Handle Crazyhouse drops
-                        mi += ((m.drop - 1) << 12)
-                    mbytes = bytes.fromhex("%0.4x" % mi)
-                    weight = bp.moves[uci].weight
-                    wbytes = bytes.fromhex("%0.4x" % weight)
-                    lbytes = bytes.fromhex("%0.8x" % 0)
-                    allbytes = zbytes + mbytes + wbytes + lbytes
-                    if weight > 0:
-                        allentries.append(allbytes)
-                        self.nummoves += 1
-                        if posnotcounted:
-                            self.numpositions += 1
-                            posnotcounted = False
-            sorted_weights = sorted(allentries, key=lambda entry: entry[10:12], reverse=True)
-            sorted_entries = sorted(sorted_weights, key=lambda entry: entry[0:8])
-            print("total of {} moves added to book {}".format(len(allentries), path))
-            for entry in sorted_entries:
-                outfile.write(entry)
+            allentries.tofile(outfile)
+
+    def merge_book(self, other):
+        for zobrist_key in other.positions:
+            bp = self.get_position(zobrist_key)
+            for mi, weight in other.positions[zobrist_key].weights.items():
+                bp.add_weight(mi, weight)
 
     def merge_file(self, path):
-        reader = chess.polyglot.open_reader(path)
+        # Raw (key, move, weight, learn) records straight from the mapped file,
+        # without building polyglot Entry or Move objects
         cnt = 0
-        for entry in reader:
-            cnt += 1
-            zobrist_key_hex = format_zobrist_key_hex(entry.key)
-            bp = self.get_position(zobrist_key_hex)
-            move = entry.move()
-            uci = move.uci()
-            bm = bp.get_move(uci)
-            bm.move = move
-            bm.weight += entry.weight
-            if cnt % 10000 == 0:
-                print("merged {} moves".format(cnt))
+        with open(path, 'rb') as infile:
+            size = os.fstat(infile.fileno()).st_size
+            size -= size % POLYGLOT_ENTRY_STRUCT.size
+            if size == 0:
+                return
+            with mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm)[:size] as data:
+                for zobrist_key, mi, weight, _ in POLYGLOT_ENTRY_STRUCT.iter_unpack(data):
+                    cnt += 1
+                    bp = self.get_position(zobrist_key)
+                    bp.add_weight(mi, weight)
+                    if cnt % 10000 == 0:
+                        print("merged {} moves".format(cnt))
 
 class LichessGame:
     def __init__(self, game):
@@ -116,10 +234,13 @@ class LichessGame:
         return game_id
 
     def get_time(self):
-        dtstr = self.game.headers["UTCDate"] + "T" + self.game.headers["UTCTime"]
-        dtobj = datetime.datetime(1970, 1, 1)
+        # Fixed "YYYY.MM.DD" / "HH:MM:SS" layout, sliced directly instead of strptime
+        d = self.game.headers["UTCDate"]
+        t = self.game.headers["UTCTime"]
         try:
-            gamedt = dtobj.strptime(dtstr, "%Y.%m.%dT%H:%M:%S")
+            gamedt = datetime.datetime(int(d[0:4]), int(d[5:7]), int(d[8:10]),
+                                       int(t[0:2]), int(t[3:5]), int(t[6:8]),
+                                       tzinfo=datetime.timezone.utc)
         except ValueError:
             gamedt = datetime.datetime.now()
         return gamedt.timestamp()
@@ -141,38 +262,91 @@ class LichessGame:
             return 2
         return 0
 
-def build_book_file(pgnpath, bookpath):
-    if not os.path.exists(pgnpath):
-        print(f"Error: PGN file {pgnpath} not found")
-        return
-    print("building book {} from {}".format(bookpath, pgnpath))
-
+def split_pgn_ranges(pgnpath, parts):
+    # Cut the file into byte ranges that each start at the first tag line of a
+    # game (a tag line right after a blank line, i.e. after the previous
+    # game's movetext), so every game falls into exactly one range
+    size = os.path.getsize(pgnpath)
+    offsets = [0]
+    with open(pgnpath, 'rb') as pgn:
+        for i in range(1, parts):
+            pgn.seek(max(size * i // parts, offsets[-1]))
+            pgn.readline()  # skip the partial line
+            prevblank = False
+            while True:
+                offset = pgn.tell()
+                line = pgn.readline()
+                if not line:
+                    offset = size
+                    break
+                if prevblank and line.startswith(b"["):
+                    break
+                prevblank = not line.strip()
+            offsets.append(offset)
+    offsets.append(size)
+    return [(start, end) for start, end in zip(offsets, offsets[1:]) if start < end]
+
+def skip_blank_lines(pgn):
+    # Leave the handle on the next non-blank line and return its offset, so a
+    # game is only started if it begins inside the worker's range
+    while True:
+        offset = pgn.tell()
+        line = pgn.readline()
+        if not line or line.strip():
+            pgn.seek(offset)
+            return offset
+
+def build_book_range(pgnpath, pgnrange):
+    start, end = pgnrange
     book = Book()
-    pgn = open(pgnpath)
+    # UTF-8 decodes without carried-over state, so tell() positions are the byte
+    # offsets split_pgn_ranges produced
+    pgn = open(pgnpath, encoding="utf-8", buffering=1 << 20)
+    pgn.seek(start)
+
+    # One board per variant, reset for every game; resetting also clears the
+    # move stack so no history builds up across games
+    boards = {
+        "Crazyhouse": chess.variant.CrazyhouseBoard(),
+        "Horde": chess.variant.HordeBoard(),
+    }
 
     cnt = 0
 
     while True:
+        # Only the headers are needed to pick the variant, so games of other
+        # variants are skipped without parsing their moves
+        offset = skip_blank_lines(pgn)
+        if offset >= end:
+            break
         try:
-            rawgame = chess.pgn.read_game(pgn)
-            if rawgame is None:
+            headers = chess.pgn.read_headers(pgn)
+            if headers is None:
                 break
         except Exception as e:
             print(f"Error reading game {cnt + 1}: {e}")
             continue
 
-        variant = rawgame.headers.get("Variant", "Standard")
-        if variant == "Crazyhouse":
-            board = chess.variant.CrazyhouseBoard()
-        elif variant == "Horde":
-            board = chess.variant.HordeBoard()
-        else:
+        variant = headers.get("Variant", "Standard")
+        board = boards.get(variant)
+        if board is None:
             print(f"Skipping unsupported variant: {variant}")
             continue
+        if headers.get("Result", "*") not in SCORED_RESULTS:
+            continue
+
+        try:
+            pgn.seek(offset)
+            rawgame = chess.pgn.read_game(pgn)
+        except Exception as e:
+            print(f"Error reading game {cnt + 1}: {e}")
+            continue
 
         # Set initial FEN if provided in PGN
         if "FEN" in rawgame.headers:
             board.set_fen(rawgame.headers["FEN"])
+        else:
+            board.reset()
 
         ligame = LichessGame(rawgame)
 
@@ -180,49 +354,27 @@ def build_book_file(pgnpath, bookpath):
         if cnt % 100 == 0:
             print("added {:8d} games".format(cnt))
 
-        zobrist_key_hex = get_zobrist_key_hex(board)
-        bp = book.get_position(zobrist_key_hex)
-        bp.fen = board.fen()
-
-        ply = 0
-        for move in rawgame.mainline():
-            if ply < MAX_BOOK_PLIES:
-                uci = move.move.uci()
-
-                # Handle castling moves for standard-like behavior
-                from_square = move.move.from_square
-                if from_square is not None:  # Normal move, not a drop
-                    fromp = board.piece_at(from_square)
-                    if fromp and fromp.piece_type == chess.KING:
-                        if uci == "e1g1":
-                            uci = "e1h1"
-                        elif uci == "e1c1":
-                            uci = "e1a1"
-                        elif uci == "e8g8":
-                            uci = "e8h8"
-                        elif uci == "e8c8":
-                            uci = "e8a8"
-
-                bm = bp.get_move(uci)
-                bm.move = move.move
-
-                game_score = ligame.score()
-                score_corr = game_score if board.turn == chess.WHITE else 2 - game_score
-                bm.weight += score_corr
-
-                board.push(move.move)
-                zobrist_key_hex = get_zobrist_key_hex(board)
-                bp = book.get_position(zobrist_key_hex)
-                bp.fen = board.fen()
-
-                ply += 1
-            else:
-                break
+        book.add_game(board, rawgame.mainline_moves(), ligame.score())
+
+    pgn.close()
+    return book
+
+def build_book_file(pgnpath, bookpath, processes=None):
+    if not os.path.exists(pgnpath):
+        print(f"Error: PGN file {pgnpath} not found")
+        return
+    print("building book {} from {}".format(bookpath, pgnpath))
+
+    # Games are independent, so each worker builds a partial book from its own
+    # byte range of the PGN and the parts are merged in file order
+    ranges = split_pgn_ranges(pgnpath, processes or os.cpu_count() or 1)
+    book = Book()
+    with multiprocessing.Pool(max(len(ranges), 1)) as pool:
+        for part in pool.imap(functools.partial(build_book_range, pgnpath), ranges):
+            book.merge_book(part)
 
     book.normalize_weights()
     book.save_as_polyglot(bookpath)
 
-    pgn.close()
-
 if __name__ == "__main__":
     build_book_file("ur.pgn", "ur.bin")
@@ -1,29 +1,121 @@
+import array
 import chess
 import chess.pgn
 import chess.polyglot
 import datetime
+import functools
+import itertools
+import mmap
+import multiprocessing
+import numpy as np
+import os
+import struct
 
 MAX_BOOK_PLIES = 20
 MAX_BOOK_WEIGHT = 10000
-
-def format_zobrist_key_hex(zobrist_key):
-    return f"{zobrist_key:016x}"
-
-def get_zobrist_key_hex(board):
-    return format_zobrist_key_hex(chess.polyglot.zobrist_hash(board))
-
-class BookMove:
-    def __init__(self):
-        self.weight = 0
-        self.move = None
+POLYGLOT_ENTRY_DTYPE = np.dtype([("key", ">u8"), ("move", ">u2"), ("weight", ">u2"), ("learn", ">u4")])
+POLYGLOT_ENTRY_STRUCT = struct.Struct(">QHHI")
+# Games with any other result (unfinished, aborted) add nothing to the book
+SCORED_RESULTS = ("1-0", "0-1", "1/2-1/2")
+
+# Polyglot encodes castling as the king capturing its own rook
+CASTLING_ROOK_SQUARES = {
+    (chess.E1, chess.G1): chess.H1,
+    (chess.E1, chess.C1): chess.A1,
+    (chess.E8, chess.G8): chess.H8,
+    (chess.E8, chess.C8): chess.A8,
+}
+
+def get_zobrist_key(board):
+    return chess.polyglot.zobrist_hash(board)
+
+def encode_polyglot_move(move):
+    mi = move.to_square | (move.from_square << 6)
+    if move.promotion:
+        mi |= (move.promotion - 1) << 12
+    elif move.drop:  # Handle Crazyhouse drops
+        mi |= (move.drop - 1) << 12
+    return mi
+
+POLYGLOT_RANDOM_ARRAY = chess.polyglot.POLYGLOT_RANDOM_ARRAY
+POLYGLOT_HASHER = chess.polyglot.ZobristHasher(POLYGLOT_RANDOM_ARRAY)
+# Variants whose moves only touch the squares ZobristBoard.push accounts for;
+# others (e.g. atomic explosions) are rehashed in full after every move
+INCREMENTAL_ZOBRIST_VARIANTS = {
+    "chess", "crazyhouse", "horde", "antichess", "racingkings", "3check", "kingofthehill",
+}
+
+def polyglot_piece_random(piece_type, color, square):
+    return POLYGLOT_RANDOM_ARRAY[64 * ((piece_type - 1) * 2 + color) + square]
+
+class ZobristBoard:
+    # Keeps the polyglot key of a board up to date by XORing in and out only
+    # what a move changes, instead of rehashing the whole position every ply.
+    def __init__(self, board):
+        self.board = board
+        self.key = get_zobrist_key(board)
+        self.castling_rights = board.castling_rights
+        self.castling_key = POLYGLOT_HASHER.hash_castling(board)
+        self.ep_key = POLYGLOT_HASHER.hash_ep_square(board) if board.ep_square else 0
+        self.incremental = board.uci_variant in INCREMENTAL_ZOBRIST_VARIANTS
+
+    def push(self, move):
+        board = self.board
+        if not self.incremental:
+            board.push(move)
+            self.key = get_zobrist_key(board)
+            return
+
+        piece_random = polyglot_piece_random
+        turn = board.turn
+        to_square = move.to_square
+        key = self.key ^ self.ep_key ^ POLYGLOT_RANDOM_ARRAY[780]
+
+        if move.drop:
+            key ^= piece_random(move.drop, turn, to_square)
+        else:
+            from_square = move.from_square
+            piece_type = board.piece_type_at(from_square)
+            key ^= piece_random(piece_type, turn, from_square)
+            if piece_type == chess.KING and board.is_castling(move):
+                back_rank = from_square & ~7
+                if chess.square_file(to_square) > chess.square_file(from_square):
+                    rook_from, king_to, rook_to = back_rank + 7, back_rank + 6, back_rank + 5
+                else:
+                    rook_from, king_to, rook_to = back_rank, back_rank + 2, back_rank + 3
+                if board.color_at(to_square) == turn:  # king takes own rook notation
+                    rook_from = to_square
+                key ^= piece_random(chess.ROOK, turn, rook_from)
+                key ^= piece_random(chess.ROOK, turn, rook_to)
+                key ^= piece_random(chess.KING, turn, king_to)
+            else:
+                if piece_type == chess.PAWN and to_square == board.ep_square and board.is_en_passant(move):
+                    victim_square = to_square - 8 if turn == chess.WHITE else to_square + 8
+                    key ^= piece_random(chess.PAWN, not turn, victim_square)
+                else:
+                    captured = board.piece_type_at(to_square)
+                    if captured:
+                        key ^= piece_random(captured, not turn, to_square)
+                key ^= piece_random(move.promotion or piece_type, turn, to_square)
+
+        board.push(move)
+
+        if board.castling_rights != self.castling_rights:
+            key ^= self.castling_key
+            self.castling_rights = board.castling_rights
+            self.castling_key = POLYGLOT_HASHER.hash_castling(board)
+            key ^= self.castling_key
+        self.ep_key = POLYGLOT_HASHER.hash_ep_square(board) if board.ep_square else 0
+        self.key = key ^ self.ep_key
 
 class BookPosition:
+    __slots__ = ('weights',)
+
     def __init__(self):
-        self.moves = {}
-        self.fen = ""
+        self.weights = {}
 
-    def get_move(self, uci):
-        return self.moves.setdefault(uci, BookMove())
+    def add_weight(self, mi, weight):
+        self.weights[mi] = self.weights.get(mi, 0) + weight
 
 class Book:
     def __init__(self):
@@ -31,60 +123,87 @@ class Book:
         self.num_positions = 0
         self.num_moves = 0
 
-    def get_position(self, zobrist_key_hex):
-        return self.positions.setdefault(zobrist_key_hex, BookPosition())
+    def get_position(self, zobrist_key):
+        # get() first so a BookPosition is only built for unseen keys
+        pos = self.positions.get(zobrist_key)
+        if pos is None:
+            pos = self.positions[zobrist_key] = BookPosition()
+        return pos
+
+    def add_game(self, board, moves, score):
+        # Everything the ply loop touches is bound to a local first
+        get_position = self.get_position
+        piece_type_at = board.piece_type_at
+        castling_rook_squares = CASTLING_ROOK_SQUARES
+        king = chess.KING
+        zboard = ZobristBoard(board)
+        push = zboard.push
+        # Score for the side to move, indexed by ply parity
+        side_scores = (score, 2 - score) if board.turn == chess.WHITE else (2 - score, score)
+        for ply, move in enumerate(itertools.islice(moves, MAX_BOOK_PLIES)):
+            weights = get_position(zboard.key).weights
+            mi = encode_polyglot_move(move)
+            rook_square = castling_rook_squares.get((move.from_square, move.to_square))
+            if rook_square is not None and piece_type_at(move.from_square) == king:
+                mi = (mi & ~0x3f) | rook_square
+            weights[mi] = weights.get(mi, 0) + side_scores[ply & 1]
+            push(move)
 
     def normalize_weights(self):
         for pos in self.positions.values():
-            total_weight = sum(bm.weight for bm in pos.moves.values())
+            total_weight = sum(pos.weights.values())
             if total_weight > 0:
-                for bm in pos.moves.values():
-                    bm.weight = int(bm.weight / total_weight * MAX_BOOK_WEIGHT)
+                for mi, weight in pos.weights.items():
+                    pos.weights[mi] = int(weight / total_weight * MAX_BOOK_WEIGHT)
 
     def save_as_polyglot(self, path):
-        with open(path, 'wb') as outfile:
-            entries = []
-
-            for key_hex, pos in self.positions.items():
-                zbytes = bytes.fromhex(key_hex)
-
-                for uci, bm in pos.moves.items():
-                    if bm.weight <= 0:
-                        continue
-
-                    move = bm.move
-                    mi = move.to_square + (move.from_square << 6)
-                    if move.promotion:
-                        mi += ((move.promotion - 1) << 12)
-
-                    mbytes = mi.to_bytes(2, byteorder="big")
-                    wbytes = bm.weight.to_bytes(2, byteorder="big")
-                    lbytes = (0).to_bytes(4, byteorder="big")
-
-                    entry = zbytes + mbytes + wbytes + lbytes
-                    entries.append(entry)
+        keys = array.array("Q")
+        moves = array.array("H")
+        weights = array.array("H")
+
+        for key, pos in self.positions.items():
+            for mi, weight in pos.weights.items():
+                if weight <= 0:
+                    continue
+
+                keys.append(key)
+                moves.append(mi)
+                weights.append(weight)
+
+        entries = np.zeros(len(keys), dtype=POLYGLOT_ENTRY_DTYPE)
+        entries["key"] = keys
+        entries["move"] = moves
+        entries["weight"] = weights
+        # Heaviest move first within each key, as polyglot readers expect: a stable
+        # radix pass on the 16-bit weights, then a stable pass on the keys
+        order = np.argsort(~np.frombuffer(weights, dtype=np.uint16), kind="stable")
+        order = order[np.argsort(np.frombuffer(keys, dtype=np.uint64)[order], kind="stable")]
+        entries = entries[order]
 
-            entries.sort(key=lambda e: (e[:8], e[10:12]), reverse=False)
+        with open(path, 'wb') as outfile:
+            entries.tofile(outfile)
 
-            for entry in entries:
-                outfile.write(entry)
+        print(f"Saved {len(entries)} moves to book: {path}")
 
-            print(f"Saved {len(entries)} moves to book: {path}")
+    def merge_book(self, other):
+        for key, other_pos in other.positions.items():
+            pos = self.get_position(key)
+            for mi, weight in other_pos.weights.items():
+                pos.add_weight(mi, weight)
 
     def merge_file(self, path):
-        with chess.polyglot.open_reader(path) as reader:
-            for i, entry in enumerate(reader, start=1):
-                key_hex = format_zobrist_key_hex(entry.key)
-                pos = self.get_position(key_hex)
-                move = entry.move()
-                uci = move.uci()
-
-                bm = pos.get_move(uci)
-                bm.move = move
-                bm.weight += entry.weight
-
-                if i % 10000 == 0:
-                    print(f"Merged {i} moves")
+        # Unpack raw records from the mapped file; no polyglot Entry/Move objects needed
+        with open(path, "rb") as book_file:
+            size = os.fstat(book_file.fileno()).st_size
+            size -= size % POLYGLOT_ENTRY_STRUCT.size
+            if size == 0:
+                return
+            with mmap.mmap(book_file.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm)[:size] as data:
+                for i, (key, mi, weight, _) in enumerate(POLYGLOT_ENTRY_STRUCT.iter_unpack(data), start=1):
+                    self.get_position(key).add_weight(mi, weight)
+
+                    if i % 10000 == 0:
+                        print(f"Merged {i} moves")
 
 class LichessGame:
     def __init__(self, game):
@@ -94,8 +213,12 @@ class LichessGame:
         return self.game.headers["Site"].split("/")[-1]
 
     def get_time(self):
-        dt_str = self.game.headers["UTCDate"] + "T" + self.game.headers["UTCTime"]
-        return datetime.datetime.strptime(dt_str, "%Y.%m.%dT%H:%M:%S").timestamp()
+        # Fixed "YYYY.MM.DD" / "HH:MM:SS" layout, sliced directly instead of strptime
+        d = self.game.headers["UTCDate"]
+        t = self.game.headers["UTCTime"]
+        return datetime.datetime(int(d[0:4]), int(d[5:7]), int(d[8:10]),
+                                 int(t[0:2]), int(t[3:5]), int(t[6:8]),
+                                 tzinfo=datetime.timezone.utc).timestamp()
 
     def result(self):
         return self.game.headers.get("Result", "*")
@@ -104,39 +227,78 @@ class LichessGame:
         res = self.result()
         return {"1-0": 2, "1/2-1/2": 1}.get(res, 0)
 
-def correct_castling_uci(uci, board):
-    if board.piece_at(chess.parse_square(uci[:2])).piece_type == chess.KING:
-        if uci == "e1g1": return "e1h1"
-        if uci == "e1c1": return "e1a1"
-        if uci == "e8g8": return "e8h8"
-        if uci == "e8c8": return "e8a8"
-    return uci
-
-def build_book_file(pgn_path, book_path):
+def split_pgn_ranges(pgn_path, parts):
+    # Byte ranges that each start at a game's first tag line (a tag line right after
+    # a blank line, i.e. after the previous movetext), so every game lands in exactly one
+    size = os.path.getsize(pgn_path)
+    offsets = [0]
+    with open(pgn_path, "rb") as pgn_file:
+        for i in range(1, parts):
+            pgn_file.seek(max(size * i // parts, offsets[-1]))
+            pgn_file.readline()  # skip the partial line
+            prev_blank = False
+            while True:
+                offset = pgn_file.tell()
+                line = pgn_file.readline()
+                if not line:
+                    offset = size
+                    break
+                if prev_blank and line.startswith(b"["):
+                    break
+                prev_blank = not line.strip()
+            offsets.append(offset)
+    offsets.append(size)
+    return [(start, end) for start, end in zip(offsets, offsets[1:]) if start < end]
+
+def skip_blank_lines(pgn_file):
+    # Leave the handle on the next non-blank line and return its offset, so a
+    # game is only started if it begins inside the worker's range
+    while True:
+        offset = pgn_file.tell()
+        line = pgn_file.readline()
+        if not line or line.strip():
+            pgn_file.seek(offset)
+            return offset
+
+def build_book_range(pgn_path, pgn_range):
+    start, end = pgn_range
     book = Book()
-    with open(pgn_path) as pgn_file:
-        for i, game in enumerate(iter(lambda: chess.pgn.read_game(pgn_file), None), start=1):
+    # Reused for every standard game that starts from the initial position
+    start_board = chess.Board()
+    # UTF-8 decodes without carried-over state, so tell() positions are the byte
+    # offsets split_pgn_ranges produced
+    with open(pgn_path, encoding="utf-8") as pgn_file:
+        pgn_file.seek(start)
+        i = 0
+        while skip_blank_lines(pgn_file) < end:
+            game = chess.pgn.read_game(pgn_file)
+            if game is None:
+                break
+
+            i += 1
             if i % 100 == 0:
                 print(f"Processed {i} games")
 
             ligame = LichessGame(game)
-            board = game.board()
-            score = ligame.score()
-            ply = 0
-
-            for move in game.mainline_moves():
-                if ply >= MAX_BOOK_PLIES:
-                    break
-
-                uci = correct_castling_uci(move.uci(), board)
-                zobrist_key_hex = get_zobrist_key_hex(board)
-                position = book.get_position(zobrist_key_hex)
-                bm = position.get_move(uci)
-                bm.move = chess.Move.from_uci(uci)
-                bm.weight += score if board.turn == chess.WHITE else (2 - score)
-
-                board.push(move)
-                ply += 1
+            if ligame.result() not in SCORED_RESULTS:
+                continue
+
+            if "FEN" in game.headers or game.headers.get("Variant", "Standard") != "Standard":
+                board = game.board()
+            else:
+                board = start_board
+                board.reset()
+            book.add_game(board, game.mainline_moves(), ligame.score())
+    return book
+
+def build_book_file(pgn_path, book_path, processes=None):
+    # Each worker builds a partial book from its own slice of the PGN; the parts
+    # are merged in file order so the result matches a single-process build
+    ranges = split_pgn_ranges(pgn_path, processes or os.cpu_count() or 1)
+    book = Book()
+    with multiprocessing.Pool(max(len(ranges), 1)) as pool:
+        for part in pool.imap(functools.partial(build_book_range, pgn_path), ranges):
+            book.merge_book(part)
 
     book.normalize_weights()
     book.save_as_polyglot(book_path)